@@ -1,15 +1,131 @@
 # -*- coding: utf-8 -*-
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-from typing import List, Dict, Optional
-import uuid
-import json
-import random
+from dataclasses import dataclass, field
+from collections import deque
+import contextlib
+from typing import Awaitable, Callable, Deque, List, Dict, Optional, Set, Tuple
+import asyncio
+import logging
+import logging.handlers
+import queue
+import secrets
+import struct
+import orjson
 
-app = FastAPI()
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
-lobbies: Dict[str, dict] = {}
-clients: Dict[str, List[WebSocket]] = {}
+log = logging.getLogger("zonezero")
+
+
+def _setup_logging():
+    """Route log records through a background thread.
+
+    Handlers here run inside the asyncio loop, so formatting and stdout
+    writes must not block it. A QueueHandler makes log calls a cheap
+    enqueue; the QueueListener does the actual I/O on its own thread.
+    """
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    log.addHandler(logging.handlers.QueueHandler(log_queue))
+    log.setLevel(logging.INFO)
+
+
+_setup_logging()
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+MESSAGE_HISTORY = 200  # chat messages kept per lobby
+MAX_CHAT_MESSAGE_LEN = 500
+
+# Encoded lobbies_list payload, shared by every get_lobbies reply until a
+# membership-visible mutation invalidates it.
+_lobbies_cache: Optional[bytes] = None
+
+def _invalidate_lobbies_cache():
+    global _lobbies_cache
+    _lobbies_cache = None
+
+@dataclass(slots=True)
+class Lobby:
+    """All state for one game lobby.
+
+    A slotted dataclass keeps per-lobby memory flat and turns the
+    per-message field accesses into attribute slot loads instead of
+    string-hashed dict lookups.
+    """
+
+    lobby_id: str
+    creator: str
+    players: List[str]
+    players_set: Set[str]
+    scores: Dict[str, int]
+    positions: Dict[str, Tuple[float, float, float]]
+    status: str = "waiting"
+    max_players: int = 4
+    seed: int = 0
+    dirty_positions: Set[str] = field(default_factory=set)
+    last_sent_positions: Dict[str, Tuple[float, float, float]] = field(default_factory=dict)
+    position_task: Optional["asyncio.Task"] = None
+    items: Dict[str, dict] = field(default_factory=dict)
+    ready_players: Set[str] = field(default_factory=set)
+    messages: Deque[dict] = field(default_factory=lambda: deque(maxlen=MESSAGE_HISTORY))
+    bonus_durations: Dict[str, float] = field(default_factory=lambda: {
+        "disable_control_others": 5.0,
+        "slow_others": 5.0,
+        "speed_up_others": 5.0
+    })
+    bonus_multipliers: Dict[str, float] = field(default_factory=lambda: {
+        "slow_multiplier": 0.5,
+        "speed_up_multiplier": 2.0
+    })
+
+class LobbyStore:
+    """In-process lobby storage.
+
+    Keeps the creator-keyed dict and the lobby_id-keyed index in sync
+    behind a narrow get/put/delete API, so handlers never touch the
+    backing dicts directly and the store can later be swapped for an
+    external (e.g. Redis-backed) implementation without changing them.
+    """
+
+    def __init__(self):
+        self._by_creator: Dict[str, Lobby] = {}
+        self._by_id: Dict[str, Lobby] = {}
+
+    def get_by_creator(self, creator: str) -> Optional[Lobby]:
+        return self._by_creator.get(creator)
+
+    def get_by_id(self, lobby_id: str) -> Optional[Lobby]:
+        return self._by_id.get(lobby_id)
+
+    def has_creator(self, creator: str) -> bool:
+        return creator in self._by_creator
+
+    def put(self, lobby: Lobby):
+        self._by_creator[lobby.creator] = lobby
+        self._by_id[lobby.lobby_id] = lobby
+        _invalidate_lobbies_cache()
+
+    def delete(self, lobby: Lobby):
+        self._by_creator.pop(lobby.creator, None)
+        self._by_id.pop(lobby.lobby_id, None)
+        _invalidate_lobbies_cache()
+
+    def all(self):
+        return self._by_creator.values()
+
+store = LobbyStore()
+clients: Dict[str, Set[WebSocket]] = {}
+socket_meta: Dict[WebSocket, Tuple[str, str]] = {}  # websocket -> (lobby_id, username)
 
 class LobbyCreateRequest(BaseModel):
     username: str
@@ -24,8 +140,67 @@ class StartGameRequest(BaseModel):
     seed: int = 0
     bonus_durations: Optional[Dict[str, float]] = None 
 
-def is_valid_username(username: str) -> bool:
-    return username.startswith("@") and len(username) > 1
+OUTBOX_MAXSIZE = 64
+SEND_TIMEOUT = 10.0  # seconds a single frame may sit in the kernel send path
+POSITION_MIN_INTERVAL = 1 / 60  # fastest accepted update_position rate per socket
+CHAT_MIN_INTERVAL = 0.2  # at most 5 chat messages per second per socket
+
+_last_position_time: Dict[WebSocket, float] = {}
+_last_chat_time: Dict[WebSocket, float] = {}
+
+def _rate_limited(websocket: WebSocket, times: Dict[WebSocket, float], min_interval: float) -> bool:
+    now = asyncio.get_running_loop().time()
+    if now - times.get(websocket, 0.0) < min_interval:
+        return True
+    times[websocket] = now
+    return False
+
+outboxes: Dict[WebSocket, asyncio.Queue] = {}
+
+def _enqueue(websocket: WebSocket, data: bytes) -> bool:
+    queue = outboxes.get(websocket)
+    if queue is None:
+        return False
+    try:
+        queue.put_nowait(data)
+    except asyncio.QueueFull:
+        return False
+    return True
+
+async def _outbox_writer(websocket: WebSocket, queue: asyncio.Queue):
+    try:
+        while True:
+            data = await queue.get()
+            await asyncio.wait_for(websocket.send_bytes(data), timeout=SEND_TIMEOUT)
+    except asyncio.TimeoutError:
+        # The peer stopped draining its socket; close it so the receive
+        # loop runs the disconnect cleanup instead of waiting for the
+        # outbox to fill.
+        try:
+            await websocket.close()
+        except Exception:
+            pass
+    except Exception:
+        # The receive loop notices the dead socket and runs the
+        # disconnect cleanup; nothing more to do here.
+        pass
+
+async def send_direct(websocket: WebSocket, message: dict):
+    _enqueue(websocket, orjson.dumps(message))
+
+_error_cache: Dict[str, bytes] = {}
+_PONG = orjson.dumps({"action": "pong"})
+
+async def send_error(websocket: WebSocket, error: str):
+    data = _error_cache.get(error)
+    if data is None:
+        data = _error_cache[error] = orjson.dumps({"error": error})
+    _enqueue(websocket, data)
+
+def is_valid_username(username) -> bool:
+    # Message values come straight out of orjson.loads, so username may
+    # be any JSON type; guard before indexing.
+    return type(username) is str and len(username) > 1 and username[0] == "@"
 
 @app.post("/create_lobby")
 async def create_lobby(request: LobbyCreateRequest):
@@ -33,35 +208,22 @@ async def create_lobby(request: LobbyCreateRequest):
     if not is_valid_username(username):
         return {"error": "Invalid username"}
     
-    if username in lobbies:
+    if store.has_creator(username):
         return {"error": "A lobby with this name already exists."}
     
-    lobby_id = str(uuid.uuid4())
-    lobbies[username] = {
-        "lobby_id": lobby_id,
-        "creator": username,
-        "players": [username],
-        "status": "waiting",
-        "max_players": 4,
-        "scores": {username: 0},
-        "seed": 0,
-        "positions": {username: {"x": 0.0, "y": 0.0, "z": 0.0}},
-        "items": {},
-        "ready_players": [],
-        "messages": [],
-        "bonus_durations": { 
-            "disable_control_others": 5.0,
-            "slow_others": 5.0,
-            "speed_up_others": 5.0
-        },
-        "bonus_multipliers": {  
-            "slow_multiplier": 0.5,
-            "speed_up_multiplier": 2.0
-        }
-    }
-    clients[lobby_id] = []
+    lobby_id = secrets.token_urlsafe(12)
+    lobby = Lobby(
+        lobby_id=lobby_id,
+        creator=username,
+        players=[username],
+        players_set={username},
+        scores={username: 0},
+        positions={username: (0.0, 0.0, 0.0)}
+    )
+    store.put(lobby)
+    clients[lobby_id] = set()
     
-    print(f"Created lobby {lobby_id} for {username}")
+    log.info(f"Created lobby {lobby_id} for {username}")
     return {
         "lobby_id": lobby_id,
         "creator": username,
@@ -75,619 +237,782 @@ async def join_lobby(request: LobbyJoinRequest):
     creator = request.creator
     username = request.username
     
-    if not (is_valid_username(creator) and is_valid_username(username)):
+    if not is_valid_username(username):
         return {"error": "Invalid username"}
     
-    if creator not in lobbies:
+    if not store.has_creator(creator):
         return {"error": "Lobby not found"}
     
-    lobby = lobbies[creator]
-    if len(lobby["players"]) >= lobby["max_players"]:
+    lobby = store.get_by_creator(creator)
+    if len(lobby.players) >= lobby.max_players:
         return {"error": "The lobby is full"}
     
-    if username in lobby["players"]:
+    if username in lobby.players_set:
         return {"error": "You are already in the lobby"}
     
-    lobby["players"].append(username)
-    lobby["scores"][username] = 0
-    lobby["positions"][username] = {"x": 0.0, "y": 0.0, "z": 0.0}
+    lobby.players.append(username)
+    lobby.players_set.add(username)
+    _invalidate_lobbies_cache()
+    lobby.scores[username] = 0
+    lobby.positions[username] = (0.0, 0.0, 0.0)
     
-    await notify_clients(lobby["lobby_id"], {
-        "lobby_id": lobby["lobby_id"],
-        "players": lobby["players"],
-        "status": lobby["status"]
+    await notify_clients(lobby.lobby_id, {
+        "lobby_id": lobby.lobby_id,
+        "players": lobby.players,
+        "status": lobby.status
     })
     
-    print(f"{username} joined lobby {lobby['lobby_id']}")
+    log.info(f"{username} joined lobby {lobby.lobby_id}")
     return {
-        "lobby_id": str(lobby["lobby_id"]),
+        "lobby_id": lobby.lobby_id,
         "creator": creator,
-        "players": lobby["players"],
-        "status": lobby["status"],
-        "messages": lobby["messages"]
+        "players": lobby.players,
+        "status": lobby.status,
+        "messages": list(lobby.messages)
     }
 
+POSITION_TICK = 1 / 20  # seconds between coalesced position broadcasts
+POSITION_EPSILON = 0.01  # axis movement below this is not worth rebroadcasting
+
+async def position_broadcaster(lobby_id: str):
+    """Flush coalesced position updates for one lobby at a fixed tick.
+
+    update_position only marks players dirty; this task merges everything
+    that changed since the last tick into a single broadcast, and exits
+    on its own once the lobby is gone.
+    """
+    while True:
+        await asyncio.sleep(POSITION_TICK)
+        lobby = store.get_by_id(lobby_id)
+        if lobby is None:
+            break
+        dirty = lobby.dirty_positions
+        if not dirty:
+            continue
+        try:
+            positions = lobby.positions
+            last_sent = lobby.last_sent_positions
+            changed = {}
+            for username in dirty:
+                current = positions.get(username)
+                if current is None:
+                    continue
+                previous = last_sent.get(username)
+                if previous is not None and all(
+                    abs(c - p) < POSITION_EPSILON for c, p in zip(current, previous)
+                ):
+                    continue
+                last_sent[username] = current
+                changed[username] = current
+            dirty.clear()
+            if not changed:
+                continue
+            await notify_clients(lobby_id, {
+                "action": "positions",
+                "lobby_id": lobby_id,
+                "positions": changed
+            })
+        except Exception:
+            # A bad stored value must not kill the lobby's only flusher;
+            # drop the tick and keep the task alive.
+            log.exception(f"Position flush failed for lobby {lobby_id}")
+            dirty.clear()
+
+def start_position_broadcaster(lobby: Lobby):
+    if lobby.position_task is None:
+        lobby.position_task = asyncio.create_task(position_broadcaster(lobby.lobby_id))
+
 @app.post("/start_game")
 async def start_game(request: StartGameRequest):
     lobby_id = request.lobby_id
     username = request.username
     seed = request.seed
     bonus_durations = request.bonus_durations
-    
-    lobby = None
-    creator = None
-    for c, l in lobbies.items():
-        if l["lobby_id"] == lobby_id:
-            lobby = l
-            creator = c
-            break
-    
+
+    lobby = store.get_by_id(lobby_id)
+
     if not lobby:
         return {"error": "Lobby not found"}
     
-    if username != lobby["creator"]:
+    if username != lobby.creator:
         return {"error": "Only the creator can start the game"}
     
     if bonus_durations:
-        lobby["bonus_durations"] = bonus_durations
-        print(f"Received bonus durations from client: {bonus_durations}")
+        lobby.bonus_durations = bonus_durations
+        log.info(f"Received bonus durations from client: {bonus_durations}")
     
-    lobby["status"] = "started"
-    lobby["seed"] = seed
+    lobby.status = "started"
+    lobby.seed = seed
+    _invalidate_lobbies_cache()
+    start_position_broadcaster(lobby)
     
     await notify_clients(lobby_id, {
         "lobby_id": lobby_id,
-        "players": lobby["players"],
+        "players": lobby.players,
         "status": "started",
         "seed": seed,
-        "items": lobby["items"]
+        "items": lobby.items
     })
     
-    print(f"Game started in lobby {lobby_id} with seed {seed}, generated {len(lobby['items'])} items")
+    log.info(f"Game started in lobby {lobby_id} with seed {seed}, generated {len(lobby.items)} items")
     return {"message": "Game has started"}
 
+async def _ws_create(websocket: WebSocket, message: dict):
+    username = message.get("username")
+    if not is_valid_username(username):
+        await send_error(websocket, "Invalid username")
+        return
+
+    if store.has_creator(username):
+        await send_error(websocket, "A lobby with this name already exists.")
+        return
+
+    lobby_id = secrets.token_urlsafe(12)
+    lobby = Lobby(
+        lobby_id=lobby_id,
+        creator=username,
+        players=[username],
+        players_set={username},
+        scores={username: 0},
+        positions={username: (0.0, 0.0, 0.0)}
+    )
+    store.put(lobby)
+    clients[lobby_id] = {websocket}
+    socket_meta[websocket] = (lobby_id, username)
+
+    await send_direct(websocket, {
+        "lobby_id": lobby_id,
+        "creator": username,
+        "players": [username],
+        "status": "waiting",
+        "messages": []
+    })
+    log.info(f"Created lobby {lobby_id} for {username}")
+
+async def _ws_join(websocket: WebSocket, message: dict):
+    creator = message.get("creator")
+    username = message.get("username")
+
+    if not is_valid_username(username):
+        await send_error(websocket, "Invalid username")
+        return
+
+    if not store.has_creator(creator):
+        await send_error(websocket, "Lobby not found")
+        return
+
+    lobby = store.get_by_creator(creator)
+    players = lobby.players
+    lobby_id = lobby.lobby_id
+    if len(players) >= lobby.max_players:
+        await send_error(websocket, "The lobby is full")
+        return
+
+    if username in lobby.players_set:
+        await send_error(websocket, "You are already in the lobby")
+        return
+
+    if lobby.status == "started":
+        await send_error(websocket, "Game already started, cannot join")
+        return
+
+    players.append(username)
+    lobby.players_set.add(username)
+    _invalidate_lobbies_cache()
+    lobby.scores[username] = 0
+    lobby.positions[username] = (0.0, 0.0, 0.0)
+    clients[lobby_id].add(websocket)
+    socket_meta[websocket] = (lobby_id, username)
+
+    await notify_clients(lobby_id, {
+        "lobby_id": lobby_id,
+        "players": players,
+        "status": "waiting"
+    })
+    log.info(f"{username} joined lobby {lobby_id}")
+
+    await send_direct(websocket, {
+        "lobby_id": lobby_id,
+        "creator": creator,
+        "players": players,
+        "status": "waiting",
+        "messages": list(lobby.messages)
+    })
+
+async def _ws_start(websocket: WebSocket, message: dict):
+    username = message.get("username")
+    lobby_id = message.get("lobby_id")
+    seed = message.get("seed", 0)
+
+    lobby = store.get_by_id(lobby_id)
+
+    if not lobby:
+        await send_error(websocket, "Lobby not found")
+        return
+
+    if username != lobby.creator:
+        await send_error(websocket, "Only the creator can start the game")
+        return
+
+    lobby.status = "started"
+    lobby.seed = seed
+    _invalidate_lobbies_cache()
+    start_position_broadcaster(lobby)
+
+    await notify_clients(lobby_id, {
+        "lobby_id": lobby_id,
+        "players": lobby.players,
+        "status": "started",
+        "seed": seed,
+        "items": lobby.items
+    })
+    log.info(f"Game started in lobby {lobby_id} with seed {seed}")
+
+async def _ws_set_bonus_data(websocket: WebSocket, message: dict):
+    username = message.get("username")
+    lobby_id = message.get("lobby_id")
+    bonus_durations = message.get("bonus_durations")
+    bonus_multipliers = message.get("bonus_multipliers")
+
+    lobby = store.get_by_id(lobby_id)
+
+    if not lobby:
+        await send_error(websocket, "Lobby not found")
+        return
+
+    if username not in lobby.players_set:
+        await send_error(websocket, "Player not in lobby")
+        return
+
+    if bonus_durations:
+        lobby.bonus_durations = bonus_durations
+
+    if bonus_multipliers:
+        lobby.bonus_multipliers = bonus_multipliers
+
+    log.info(f"Updated bonus data for lobby {lobby_id}: durations={bonus_durations}, multipliers={bonus_multipliers}")
+    await send_direct(websocket, {"message": "Bonus data updated"})
+
+async def _ws_leave(websocket: WebSocket, message: dict):
+    lobby_id = message.get("lobby_id")
+    username = message.get("username")
+
+    lobby = store.get_by_id(lobby_id)
+
+    if not lobby:
+        await send_error(websocket, "Lobby not found")
+        return
+
+    if username == lobby.creator:
+        if lobby_id in clients:
+            for client in clients[lobby_id]:
+                socket_meta.pop(client, None)
+                if client != websocket:
+                    try:
+                        await send_error(client, "Lobby closed by creator")
+                    except Exception as e:
+                        log.warning(f"Error notifying client in lobby {lobby_id}: {e}")
+            del clients[lobby_id]
+        store.delete(lobby)
+        log.info(f"Lobby {lobby_id} deleted by creator {username}")
+        await send_direct(websocket, {"message": "Lobby closed"})
+    else:
+        if username in lobby.players_set:
+            lobby.players.remove(username)
+            lobby.players_set.discard(username)
+            _invalidate_lobbies_cache()
+            del lobby.scores[username]
+            del lobby.positions[username]
+            lobby.ready_players.discard(username)
+            if lobby_id in clients:
+                clients[lobby_id].discard(websocket)
+            socket_meta.pop(websocket, None)
+            await notify_clients(lobby_id, {
+                "lobby_id": lobby_id,
+                "players": lobby.players,
+                "status": lobby.status
+            })
+            log.info(f"{username} left lobby {lobby_id}")
+            await send_direct(websocket, {"message": "Left lobby"})
+
+async def _ws_ready(websocket: WebSocket, message: dict):
+    username = message.get("username")
+    lobby_id = message.get("lobby_id")
+
+    lobby = store.get_by_id(lobby_id)
+
+    if not lobby:
+        await send_error(websocket, "Lobby not found")
+        return
+
+    if username not in lobby.players_set:
+        await send_error(websocket, "Player not in lobby")
+        return
+
+    ready_players = lobby.ready_players
+    players = lobby.players
+    if username not in ready_players:
+        ready_players.add(username)
+        log.info(f"{username} signaled ready in lobby {lobby_id}. Ready players: {len(ready_players)}/{len(players)}")
+
+        if len(ready_players) == len(players):
+            log.info(f"All players ready in lobby {lobby_id}, broadcasting start_game")
+            await notify_clients(lobby_id, {
+                "action": "start_game",
+                "lobby_id": lobby_id
+            })
+
+async def _ws_update_position(websocket: WebSocket, message: dict):
+    # Above 60 Hz, newer updates carry no extra information for the
+    # 20 Hz flusher; drop the excess silently.
+    if _rate_limited(websocket, _last_position_time, POSITION_MIN_INTERVAL):
+        return
+    lobby_id = message.get("lobby_id")
+    username = message.get("username")
+    x = message.get("x", 0.0)
+    y = message.get("y", 0.0)
+    z = message.get("z", 0.0)
+    if not (type(x) in (int, float) and type(y) in (int, float) and type(z) in (int, float)):
+        await send_error(websocket, "Invalid message format")
+        return
+
+    lobby = store.get_by_id(lobby_id)
+
+    if not lobby:
+        await send_error(websocket, "Lobby not found")
+        return
+
+    if username not in lobby.players_set:
+        await send_error(websocket, "Player not in lobby")
+        return
+
+    lobby.positions[username] = (x, y, z)
+    lobby.dirty_positions.add(username)
+
+async def _ws_collect_item(websocket: WebSocket, message: dict):
+    lobby_id = message.get("lobby_id")
+    username = message.get("username")
+    item_id = message.get("item_id")
+
+    lobby = store.get_by_id(lobby_id)
+
+    if not lobby:
+        await send_error(websocket, "Lobby not found")
+        return
+
+    if username not in lobby.players_set:
+        await send_error(websocket, "Player not in lobby")
+        return
+
+    items = lobby.items
+    item = items.get(item_id)
+    if item is None:
+        await send_error(websocket, "Item not found")
+        return
+
+    if item["collected"]:
+        await send_error(websocket, "Item already collected")
+        return
+
+    item["collected"] = True
+    scores = lobby.scores
+    scores[username] = scores.get(username, 0) + 1
+    log.info(f"Item {item_id} collected by {username} in lobby {lobby_id}, new score: {scores[username]}")
+
+    await notify_clients(lobby_id, {
+        "action": "item_collected",
+        "lobby_id": lobby_id,
+        "item_id": item_id,
+        "username": username,
+        "score_delta": {username: scores[username]}
+    })
+
+async def _ws_collect_bonus(websocket: WebSocket, message: dict):
+    lobby_id = message.get("lobby_id")
+    username = message.get("username")
+    item_id = message.get("item_id")
+    bonus_type = message.get("bonus_type")
+
+    lobby = store.get_by_id(lobby_id)
+
+    if not lobby:
+        await send_error(websocket, "Lobby not found")
+        return
+
+    if username not in lobby.players_set:
+        await send_error(websocket, "Player not in lobby")
+        return
+
+    item = lobby.items.get(item_id)
+    if item is None:
+        await send_error(websocket, "Item not found")
+        return
+
+    if not item["is_bonus"]:
+        await send_error(websocket, "Item is not a bonus item")
+        return
+
+    if item["collected"]:
+        await send_error(websocket, "Bonus item already collected")
+        return
+
+    item["collected"] = True
+    players = lobby.players
+    log.info(f"Bonus item {item_id} collected by {username} in lobby {lobby_id}, bonus_type: {bonus_type}")
+
+    await notify_clients(lobby_id, {
+        "action": "item_collected",
+        "lobby_id": lobby_id,
+        "item_id": item_id,
+        "username": username,
+        "bonus_type": bonus_type
+    })
+
+    bonus_durations = lobby.bonus_durations
+    bonus_multipliers = lobby.bonus_multipliers
+    targets = [player for player in players if player != username]
+
+    if bonus_type == "disable_control_others":
+        duration = bonus_durations.get("disable_control_others")
+        if duration is None:
+            duration = 5.0
+            log.warning(f"disable_control_others duration not found, using default: {duration}")
+
+        await notify_clients(lobby_id, {
+            "action": "apply_effect",
+            "effect_type": "disable_control",
+            "targets": targets,
+            "duration": duration
+        })
+
+    elif bonus_type == "slow_others":
+        duration = bonus_durations.get("slow_others")
+        if duration is None:
+            duration = 5.0
+            log.warning(f"slow_others duration not found, using default: {duration}")
+
+        speed_multiplier = bonus_multipliers.get("slow_multiplier")
+        if speed_multiplier is None:
+            speed_multiplier = 0.5
+            log.warning(f"slow_multiplier not found, using default: {speed_multiplier}")
+
+        await notify_clients(lobby_id, {
+            "action": "apply_effect",
+            "effect_type": "slow_others",
+            "targets": targets,
+            "duration": duration,
+            "speed_multiplier": speed_multiplier
+        })
+
+    elif bonus_type == "speed_up_others":
+        duration = bonus_durations.get("speed_up_others")
+        if duration is None:
+            duration = 5.0
+            log.warning(f"speed_up_others duration not found, using default: {duration}")
+
+        speed_multiplier = bonus_multipliers.get("speed_up_multiplier")
+        if speed_multiplier is None:
+            speed_multiplier = 2.0
+            log.warning(f"speed_up_multiplier not found, using default: {speed_multiplier}")
+
+        await notify_clients(lobby_id, {
+            "action": "apply_effect",
+            "effect_type": "speed_up_others",
+            "targets": targets,
+            "duration": duration,
+            "speed_multiplier": speed_multiplier
+        })
+
+async def _ws_register_items(websocket: WebSocket, message: dict):
+    lobby_id = message.get("lobby_id")
+    items = message.get("items", [])
+
+    lobby = store.get_by_id(lobby_id)
+
+    if not lobby:
+        await send_error(websocket, "Lobby not found")
+        return
+
+    lobby.items = {}
+    for item in items:
+        item_id = item.get("item_id")
+        if item_id:
+            lobby.items[item_id] = {
+                "collected": False,
+                "position": item.get("position", {"x": 0, "y": 0, "z": 0}),
+                "is_bonus": item.get("is_bonus", False),
+                "bonus_type": item.get("bonus_type", "")
+            }
+
+    await notify_clients(lobby_id, {
+        "action": "items_registered",
+        "lobby_id": lobby_id,
+        "items_count": len(lobby.items)
+    })
+
+    log.info(f"Registered {len(lobby.items)} items in lobby {lobby_id}")
+
+async def _ws_send_message(websocket: WebSocket, message: dict):
+    if _rate_limited(websocket, _last_chat_time, CHAT_MIN_INTERVAL):
+        await send_error(websocket, "Too many messages")
+        return
+    lobby_id = message.get("lobby_id")
+    username = message.get("username")
+    chat_message = message.get("message")
+
+    lobby = store.get_by_id(lobby_id)
+
+    if not lobby:
+        await send_error(websocket, "Lobby not found")
+        return
+
+    if username not in lobby.players_set:
+        await send_error(websocket, "Player not in lobby")
+        return
+
+    if not chat_message or len(chat_message.strip()) == 0:
+        await send_error(websocket, "Message cannot be empty")
+        return
+
+    if len(chat_message) > MAX_CHAT_MESSAGE_LEN:
+        await send_error(websocket, "Message too long")
+        return
+
+    lobby.messages.append({"username": username, "message": chat_message})
+    log.info(f"Message from {username} in lobby {lobby_id}: {chat_message}")
+
+    await notify_clients(lobby_id, {
+        "action": "chat_message",
+        "lobby_id": lobby_id,
+        "username": username,
+        "message": chat_message
+    })
+
+async def _ws_get_lobbies(websocket: WebSocket, message: dict):
+    global _lobbies_cache
+    payload = _lobbies_cache
+    if payload is None:
+        available_lobbies = [
+            {
+                "lobby_id": lobby.lobby_id,
+                "creator": lobby.creator,
+                "current_players": len(lobby.players),
+                "max_players": lobby.max_players
+            }
+            for lobby in store.all()
+            if lobby.status == "waiting"
+        ]
+        payload = _lobbies_cache = orjson.dumps({
+            "action": "lobbies_list",
+            "lobbies": available_lobbies
+        })
+    _enqueue(websocket, payload)
+    log.info(f"Sent lobbies list to client {websocket.client.host}")
+
+async def _ws_ping(websocket: WebSocket, message: dict):
+    _enqueue(websocket, _PONG)
+    if log.isEnabledFor(logging.DEBUG):
+        username = message.get("username", f"Unknown_{websocket.client.host}")
+        log.debug(f"Ping received from {username}, sent pong")
+
+HANDLERS: Dict[str, Callable[[WebSocket, dict], Awaitable[None]]] = {
+    "create": _ws_create,
+    "join": _ws_join,
+    "start": _ws_start,
+    "set_bonus_data": _ws_set_bonus_data,
+    "leave": _ws_leave,
+    "ready": _ws_ready,
+    "update_position": _ws_update_position,
+    "collect_item": _ws_collect_item,
+    "collect_bonus": _ws_collect_bonus,
+    "register_items": _ws_register_items,
+    "send_message": _ws_send_message,
+    "get_lobbies": _ws_get_lobbies,
+    "ping": _ws_ping,
+}
+
+POSITION_OPCODE = 0x01
+_POSITION_FLOATS = struct.Struct("!fff")
+
+async def _binary_update_position(websocket: WebSocket, frame: bytes):
+    """Packed position update: [op=0x01][name_len][name][x y z float32].
+
+    High-rate position traffic skips JSON entirely; the lobby comes from
+    socket_meta, so the frame carries only the username and coordinates.
+    """
+    if _rate_limited(websocket, _last_position_time, POSITION_MIN_INTERVAL):
+        return
+    try:
+        name_len = frame[1]
+        username = frame[2:2 + name_len].decode()
+        x, y, z = _POSITION_FLOATS.unpack_from(frame, 2 + name_len)
+    except (IndexError, struct.error, UnicodeDecodeError):
+        await send_error(websocket, "Invalid message format")
+        return
+
+    meta = socket_meta.get(websocket)
+    lobby = store.get_by_id(meta[0]) if meta else None
+    if lobby is None:
+        await send_error(websocket, "Lobby not found")
+        return
+    if username not in lobby.players_set:
+        await send_error(websocket, "Player not in lobby")
+        return
+
+    lobby.positions[username] = (x, y, z)
+    lobby.dirty_positions.add(username)
+
+JANITOR_INTERVAL = 60.0
+
+async def janitor():
+    """Reap lobbies that have lost all their sockets.
+
+    The leave/disconnect paths clean up eagerly; this is a backstop for
+    anything that slips past them, such as a lobby created over REST
+    whose creator never opens a WebSocket. A lobby is only reaped after
+    being seen empty on two consecutive passes, so fresh lobbies get a
+    grace period of one interval.
+    """
+    candidates: Set[str] = set()
+    while True:
+        await asyncio.sleep(JANITOR_INTERVAL)
+        empty = {lobby.lobby_id for lobby in list(store.all()) if not clients.get(lobby.lobby_id)}
+        for lobby_id in candidates & empty:
+            lobby = store.get_by_id(lobby_id)
+            if lobby is not None:
+                store.delete(lobby)
+            clients.pop(lobby_id, None)
+            log.warning(f"Janitor reaped empty lobby {lobby_id}")
+        candidates = empty - candidates
+
+_janitor_task: Optional["asyncio.Task"] = None
+
+@app.on_event("startup")
+async def _start_janitor():
+    global _janitor_task
+    _janitor_task = asyncio.create_task(janitor())
+
 @app.websocket("/ws/lobby")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     client_ip = websocket.client.host
-    print(f"WebSocket client connected: {client_ip}")
-    
+    log.info(f"WebSocket client connected: {client_ip}")
+
+    # One bounded outbound queue per connection: broadcasts enqueue without
+    # blocking, and a dedicated writer task drains it, so one congested
+    # socket cannot stall fan-out to healthy peers.
+    outbox = asyncio.Queue(maxsize=OUTBOX_MAXSIZE)
+    outboxes[websocket] = outbox
+    writer = asyncio.create_task(_outbox_writer(websocket, outbox))
+
+    # Bind per-frame lookups once; each loop iteration then uses LOAD_FAST
+    # instead of re-resolving the attribute/global.
+    receive = websocket.receive
+    loads = orjson.loads
+    handlers_get = HANDLERS.get
+
     try:
         while True:
-            try:
-                data = await websocket.receive_text()
-                print(f"Received message from {client_ip}: {data}")
-                message = json.loads(data)
-                action = message.get("action")
-                
-                if action == "create":
-                    username = message.get("username")
-                    if not is_valid_username(username):
-                        await websocket.send_json({"error": "Invalid username"})
-                        continue
-                    
-                    if username in lobbies:
-                        await websocket.send_json({"error": "A lobby with this name already exists."})
-                        continue
-                    
-                    lobby_id = str(uuid.uuid4())
-                    lobbies[username] = {
-                        "lobby_id": lobby_id,
-                        "creator": username,
-                        "players": [username],
-                        "status": "waiting",
-                        "max_players": 4,
-                        "scores": {username: 0},
-                        "seed": 0,
-                        "positions": {username: {"x": 0.0, "y": 0.0, "z": 0.0}},
-                        "items": {},
-                        "ready_players": [],
-                        "messages": [],
-                        "bonus_durations": {
-                            "disable_control_others": 5.0,
-                            "slow_others": 5.0,
-                            "speed_up_others": 5.0
-                        },
-                        "bonus_multipliers": {
-                            "slow_multiplier": 0.5,
-                            "speed_up_multiplier": 2.0
-                        }
-                    }
-                    clients[lobby_id] = [websocket]
-                    
-                    await websocket.send_json({
-                        "lobby_id": str(lobby_id),
-                        "creator": username,
-                        "players": [username],
-                        "status": "waiting",
-                        "messages": []
-                    })
-                    print(f"Created lobby {lobby_id} for {username}")
-                
-                elif action == "join":
-                    creator = message.get("creator")
-                    username = message.get("username")
-                    
-                    if not (is_valid_username(creator) and is_valid_username(username)):
-                        await websocket.send_json({"error": "Invalid username"})
-                        continue
-                    
-                    if creator not in lobbies:
-                        await websocket.send_json({"error": "Lobby not found"})
-                        continue
-                    
-                    lobby = lobbies[creator]
-                    if len(lobby["players"]) >= lobby["max_players"]:
-                        await websocket.send_json({"error": "The lobby is full"})
-                        continue
-                    
-                    if username in lobby["players"]:
-                        await websocket.send_json({"error": "You are already in the lobby"})
-                        continue
-                    
-                    if lobby["status"] == "started":
-                        await websocket.send_json({"error": "Game already started, cannot join"})
-                        continue
-                    
-                    lobby["players"].append(username)
-                    lobby["scores"][username] = 0
-                    lobby["positions"][username] = {"x": 0.0, "y": 0.0, "z": 0.0}
-                    clients[lobby["lobby_id"]].append(websocket)
-                    
-                    await notify_clients(lobby["lobby_id"], {
-                        "lobby_id": str(lobby["lobby_id"]),
-                        "players": lobby["players"],
-                        "status": "waiting"
-                    })
-                    print(f"{username} joined lobby {lobby['lobby_id']}")
-                    
-                    await websocket.send_json({
-                        "lobby_id": str(lobby["lobby_id"]),
-                        "creator": creator,
-                        "players": lobby["players"],
-                        "status": "waiting",
-                        "messages": lobby["messages"]
-                    })
-                
-                elif action == "start":
-                    username = message.get("username")
-                    lobby_id = message.get("lobby_id")
-                    seed = message.get("seed", 0)
-                    
-                    lobby = None
-                    creator = None
-                    for c, l in lobbies.items():
-                        if l["lobby_id"] == lobby_id:
-                            lobby = l
-                            creator = c
-                            break
-                    
-                    if not lobby:
-                        await websocket.send_json({"error": "Lobby not found"})
-                        continue
-                    
-                    if username != lobby["creator"]:
-                        await websocket.send_json({"error": "Only the creator can start the game"})
-                        continue
-                    
-                    lobby["status"] = "started"
-                    lobby["seed"] = seed
-                    
-                    await notify_clients(lobby_id, {
-                        "lobby_id": str(lobby_id),
-                        "players": lobby["players"],
-                        "status": "started",
-                        "seed": seed,
-                        "items": lobby["items"]
-                    })
-                    print(f"Game started in lobby {lobby_id} with seed {seed}")
-                
-                elif action == "set_bonus_data": 
-                    username = message.get("username")
-                    lobby_id = message.get("lobby_id")
-                    bonus_durations = message.get("bonus_durations")
-                    bonus_multipliers = message.get("bonus_multipliers")
-                    
-                    lobby = None
-                    for c, l in lobbies.items():
-                        if l["lobby_id"] == lobby_id:
-                            lobby = l
-                            break
-                    
-                    if not lobby:
-                        await websocket.send_json({"error": "Lobby not found"})
-                        continue
-                    
-                    if username not in lobby["players"]:
-                        await websocket.send_json({"error": "Player not in lobby"})
-                        continue
-                    
-                    if bonus_durations:
-                        lobby["bonus_durations"] = bonus_durations
-                    
-                    if bonus_multipliers:
-                        lobby["bonus_multipliers"] = bonus_multipliers
-                    
-                    print(f"Updated bonus data for lobby {lobby_id}: durations={bonus_durations}, multipliers={bonus_multipliers}")
-                    await websocket.send_json({"message": "Bonus data updated"})
-                
-                elif action == "leave":
-                    lobby_id = message.get("lobby_id")
-                    username = message.get("username")
-                    
-                    lobby = None
-                    creator = None
-                    for c, l in lobbies.items():
-                        if l["lobby_id"] == lobby_id:
-                            lobby = l
-                            creator = c
-                            break
-                    
-                    if not lobby:
-                        await websocket.send_json({"error": "Lobby not found"})
-                        continue
-                    
-                    if username == lobby["creator"]:
-                        if lobby_id in clients:
-                            for client in clients[lobby_id]:
-                                if client != websocket:
-                                    try:
-                                        await client.send_json({"error": "Lobby closed by creator"})
-                                    except Exception as e:
-                                        print(f"Error notifying client in lobby {lobby_id}: {e}")
-                            del clients[lobby_id]
-                        del lobbies[creator]
-                        print(f"Lobby {lobby_id} deleted by creator {username}")
-                        await websocket.send_json({"message": "Lobby closed"})
-                    else:
-                        if username in lobby["players"]:
-                            lobby["players"].remove(username)
-                            del lobby["scores"][username]
-                            del lobby["positions"][username]
-                            if username in lobby["ready_players"]:
-                                lobby["ready_players"].remove(username)
-                            if lobby_id in clients:
-                                if websocket in clients[lobby_id]:
-                                    clients[lobby_id].remove(websocket)
-                            await notify_clients(lobby_id, {
-                                "lobby_id": lobby_id,
-                                "players": lobby["players"],
-                                "status": lobby["status"]
-                            })
-                            print(f"{username} left lobby {lobby_id}")
-                            await websocket.send_json({"message": "Left lobby"})
-                
-                elif action == "ready":
-                    username = message.get("username")
-                    lobby_id = message.get("lobby_id")
-                    
-                    lobby = None
-                    for c, l in lobbies.items():
-                        if l["lobby_id"] == lobby_id:
-                            lobby = l
-                            break
-                    
-                    if not lobby:
-                        await websocket.send_json({"error": "Lobby not found"})
-                        continue
-                    
-                    if username not in lobby["players"]:
-                        await websocket.send_json({"error": "Player not in lobby"})
-                        continue
-                    
-                    if username not in lobby["ready_players"]:
-                        lobby["ready_players"].append(username)
-                        print(f"{username} signaled ready in lobby {lobby_id}. Ready players: {len(lobby['ready_players'])}/{len(lobby['players'])}")
-                        
-                        if len(lobby["ready_players"]) == len(lobby["players"]):
-                            print(f"All players ready in lobby {lobby_id}, broadcasting start_game")
-                            await notify_clients(lobby_id, {
-                                "action": "start_game",
-                                "lobby_id": lobby_id
-                            })
-                
-                elif action == "update_position":
-                    lobby_id = message.get("lobby_id")
-                    username = message.get("username")
-                    x = message.get("x", 0.0)
-                    y = message.get("y", 0.0)
-                    z = message.get("z", 0.0)
-                    
-                    lobby = None
-                    for c, l in lobbies.items():
-                        if l["lobby_id"] == lobby_id:
-                            lobby = l
-                            break
-                    
-                    if not lobby:
-                        await websocket.send_json({"error": "Lobby not found"})
-                        continue
-                    
-                    if username not in lobby["players"]:
-                        await websocket.send_json({"error": "Player not in lobby"})
-                        continue
-                    
-                    lobby["positions"][username] = {"x": x, "y": y, "z": z}
-                    print(f"Updated position for {username} in lobby {lobby_id}: x={x}, y={y}, z={z}")
-                    
-                    await notify_clients(lobby_id, {
-                        "action": "update_position",
-                        "lobby_id": lobby_id,
-                        "username": username,
-                        "x": x,
-                        "y": y,
-                        "z": z
-                    })
-                
-                elif action == "collect_item":
-                    lobby_id = message.get("lobby_id")
-                    username = message.get("username")
-                    item_id = message.get("item_id")
-                    
-                    lobby = None
-                    for c, l in lobbies.items():
-                        if l["lobby_id"] == lobby_id:
-                            lobby = l
-                            break
-                    
-                    if not lobby:
-                        await websocket.send_json({"error": "Lobby not found"})
-                        continue
-                    
-                    if username not in lobby["players"]:
-                        await websocket.send_json({"error": "Player not in lobby"})
-                        continue
-                    
-                    if item_id not in lobby["items"]:
-                        await websocket.send_json({"error": "Item not found"})
-                        continue
-                    
-                    if lobby["items"][item_id]["collected"]:
-                        await websocket.send_json({"error": "Item already collected"})
-                        continue
-                    
-                    lobby["items"][item_id]["collected"] = True
-                    lobby["scores"][username] = lobby["scores"].get(username, 0) + 1
-                    print(f"Item {item_id} collected by {username} in lobby {lobby_id}, new score: {lobby['scores'][username]}")
-                    
-                    await notify_clients(lobby_id, {
-                        "action": "item_collected",
-                        "lobby_id": lobby_id,
-                        "item_id": item_id,
-                        "username": username,
-                        "scores": lobby["scores"]
-                    })
-                
-                elif action == "collect_bonus":
-                    lobby_id = message.get("lobby_id")
-                    username = message.get("username")
-                    item_id = message.get("item_id")
-                    bonus_type = message.get("bonus_type")
-    
-                    lobby = None
-                    for c, l in lobbies.items():
-                        if l["lobby_id"] == lobby_id:
-                            lobby = l
-                            break
-    
-                    if not lobby:
-                        await websocket.send_json({"error": "Lobby not found"})
-                        continue
-    
-                    if username not in lobby["players"]:
-                        await websocket.send_json({"error": "Player not in lobby"})
-                        continue
-    
-                    if item_id not in lobby["items"]:
-                        await websocket.send_json({"error": "Item not found"})
-                        continue
-    
-                    if not lobby["items"][item_id]["is_bonus"]:
-                        await websocket.send_json({"error": "Item is not a bonus item"})
-                        continue
-    
-                    if lobby["items"][item_id]["collected"]:
-                        await websocket.send_json({"error": "Bonus item already collected"})
-                        continue
-    
-                    lobby["items"][item_id]["collected"] = True
-                    print(f"Bonus item {item_id} collected by {username} in lobby {lobby_id}, bonus_type: {bonus_type}")
-    
-                    await notify_clients(lobby_id, {
-                        "action": "item_collected",
-                        "lobby_id": lobby_id,
-                        "item_id": item_id,
-                        "username": username,
-                        "bonus_type": bonus_type
-                    })
-    
-                    bonus_durations = lobby.get("bonus_durations", {})
-                    bonus_multipliers = lobby.get("bonus_multipliers", {})
-    
-                    if bonus_type == "disable_control_others":
-                        duration = bonus_durations.get("disable_control_others")
-                        if duration is None:  
-                            duration = 5.0
-                            print(f"Warning: disable_control_others duration not found, using default: {duration}")
-                        
-                        for player in lobby["players"]:
-                            if player != username:
-                                await notify_clients(lobby_id, {
-                                    "action": "apply_effect",
-                                    "effect_type": "disable_control",
-                                    "target_username": player,
-                                    "duration": duration
-                                })
-                    
-                    elif bonus_type == "slow_others":
-                        duration = bonus_durations.get("slow_others")
-                        if duration is None:
-                            duration = 5.0
-                            print(f"Warning: slow_others duration not found, using default: {duration}")
-                        
-                        speed_multiplier = bonus_multipliers.get("slow_multiplier")
-                        if speed_multiplier is None:
-                            speed_multiplier = 0.5
-                            print(f"Warning: slow_multiplier not found, using default: {speed_multiplier}")
-                        
-                        for player in lobby["players"]:
-                            if player != username:
-                                await notify_clients(lobby_id, {
-                                    "action": "apply_effect",
-                                    "effect_type": "slow_others",
-                                    "target_username": player,
-                                    "duration": duration,
-                                    "speed_multiplier": speed_multiplier
-                                })
-                    
-                    elif bonus_type == "speed_up_others":
-                        duration = bonus_durations.get("speed_up_others")
-                        if duration is None:
-                            duration = 5.0
-                            print(f"Warning: speed_up_others duration not found, using default: {duration}")
-                        
-                        speed_multiplier = bonus_multipliers.get("speed_up_multiplier")
-                        if speed_multiplier is None:
-                            speed_multiplier = 2.0
-                            print(f"Warning: speed_up_multiplier not found, using default: {speed_multiplier}")
-                        
-                        for player in lobby["players"]:
-                            if player != username:
-                                await notify_clients(lobby_id, {
-                                    "action": "apply_effect",
-                                    "effect_type": "speed_up_others",
-                                    "target_username": player,
-                                    "duration": duration,
-                                    "speed_multiplier": speed_multiplier
-                                })
-                
-                elif action == "register_items":
-                    lobby_id = message.get("lobby_id")
-                    items = message.get("items", [])
-       
-                    lobby = None
-                    for c, l in lobbies.items():
-                        if l["lobby_id"] == lobby_id:
-                            lobby = l
-                            break
-       
-                    if not lobby:
-                        await websocket.send_json({"error": "Lobby not found"})
-                        continue
-       
-                    lobby["items"] = {}
-                    for item in items:
-                        item_id = item.get("item_id")
-                        if item_id:
-                            lobby["items"][item_id] = {
-                                "collected": False,
-                                "position": item.get("position", {"x": 0, "y": 0, "z": 0}),
-                                "is_bonus": item.get("is_bonus", False),
-                                "bonus_type": item.get("bonus_type", "")
-                            }
-       
-                    await notify_clients(lobby_id, {
-                        "action": "items_registered",
-                        "lobby_id": lobby_id,
-                        "items_count": len(lobby["items"])
-                    })
-       
-                    print(f"Registered {len(lobby['items'])} items in lobby {lobby_id}")
-                
-                elif action == "send_message":
-                    lobby_id = message.get("lobby_id")
-                    username = message.get("username")
-                    chat_message = message.get("message")
-                    
-                    lobby = None
-                    for c, l in lobbies.items():
-                        if l["lobby_id"] == lobby_id:
-                            lobby = l
-                            break
-                    
-                    if not lobby:
-                        await websocket.send_json({"error": "Lobby not found"})
-                        continue
-                    
-                    if username not in lobby["players"]:
-                        await websocket.send_json({"error": "Player not in lobby"})
-                        continue
-                    
-                    if not chat_message or len(chat_message.strip()) == 0:
-                        await websocket.send_json({"error": "Message cannot be empty"})
-                        continue
-                        
-                    lobby["messages"].append({"username": username, "message": chat_message})
-                    print(f"Message from {username} in lobby {lobby_id}: {chat_message}")
-                    
-                    await notify_clients(lobby_id, {
-                        "action": "chat_message",
-                        "lobby_id": lobby_id,
-                        "username": username,
-                        "message": chat_message
-                    })
-                
-                elif action == "get_lobbies":
-                    available_lobbies = [
-                        {
-                            "lobby_id": lobby["lobby_id"],
-                            "creator": creator,
-                            "current_players": len(lobby["players"]),
-                            "max_players": lobby["max_players"]
-                        }
-                        for creator, lobby in lobbies.items()
-                        if lobby["status"] == "waiting"
-                    ]
-                    await websocket.send_json({
-                        "action": "lobbies_list",
-                        "lobbies": available_lobbies
-                    })
-                    print(f"Sent {len(available_lobbies)} available lobbies to client {client_ip}")
-                
-                elif action == "ping":
-                    username = message.get("username", f"Unknown_{client_ip}")
-                    await websocket.send_json({"action": "pong"})
-                    print(f"Ping received from {username}, sent pong")
-            
-            except WebSocketDisconnect:
+            frame = await receive()
+            if frame["type"] == "websocket.disconnect":
                 await handle_disconnect(websocket)
-                break
-    
-    except WebSocketDisconnect:
+                return
+            raw = frame.get("bytes")
+            if raw is not None:
+                if raw and raw[0] == POSITION_OPCODE:
+                    await _binary_update_position(websocket, raw)
+                    continue
+                data = raw
+            else:
+                data = frame["text"]
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(f"Received message from {client_ip}: {data}")
+            try:
+                message = loads(data)
+            except orjson.JSONDecodeError:
+                await send_error(websocket, "Invalid message format")
+                continue
+            if not isinstance(message, dict):
+                await send_error(websocket, "Invalid message format")
+                continue
+            handler = handlers_get(message.get("action"))
+            if handler is None:
+                continue
+            try:
+                await handler(websocket, message)
+            except (TypeError, KeyError, ValueError, AttributeError):
+                # A malformed message should cost the sender one error
+                # reply, not the whole connection.
+                log.warning(f"Malformed {message.get('action')!r} message from {client_ip}")
+                await send_error(websocket, "Invalid message format")
+
+    except Exception:
+        # Anything the per-message guards did not catch; clean up the
+        # lobby state rather than leaking the player.
+        log.exception(f"Unexpected error on connection from {client_ip}")
         await handle_disconnect(websocket)
+    finally:
+        writer.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await writer
+        outboxes.pop(websocket, None)
+        _last_position_time.pop(websocket, None)
+        _last_chat_time.pop(websocket, None)
 
 async def handle_disconnect(websocket: WebSocket):
     client_ip = websocket.client.host
-    for lobby_id, client_list in list(clients.items()):
-        if websocket in client_list:
-            client_list.remove(websocket)
-            for creator, lobby in list(lobbies.items()):
-                if lobby["lobby_id"] == lobby_id:
-                    if not client_list:
-                        del lobbies[creator]
-                        print(f"Lobby {lobby_id} deleted due to no clients")
-                    else:
-                        for username in list(lobby["players"]):
-                            if username != lobby["creator"]:
-                                lobby["players"].remove(username)
-                                del lobby["scores"][username]
-                                del lobby["positions"][username]
-                                if username in lobby["ready_players"]:
-                                    lobby["ready_players"].remove(username)
-                                await notify_clients(lobby_id, {
-                                    "lobby_id": lobby_id,
-                                    "players": lobby["players"],
-                                    "status": lobby["status"]
-                                })
-                                print(f"Removed {username} from lobby {lobby_id} due to disconnect")
-            print(f"WebSocket client disconnected: {client_ip}")
-            break
+    lobby_id, username = socket_meta.pop(websocket, (None, None))
+    if lobby_id is None:
+        return
+    client_set = clients.get(lobby_id)
+    if client_set is not None:
+        client_set.discard(websocket)
+    lobby = store.get_by_id(lobby_id)
+    if lobby is not None:
+        if not client_set or username == lobby.creator:
+            for client in client_set or ():
+                socket_meta.pop(client, None)
+                await send_error(client, "Lobby closed by creator")
+            clients.pop(lobby_id, None)
+            store.delete(lobby)
+            log.info(f"Lobby {lobby_id} deleted after {username} disconnected")
+        elif username in lobby.players_set:
+            lobby.players.remove(username)
+            lobby.players_set.discard(username)
+            _invalidate_lobbies_cache()
+            del lobby.scores[username]
+            del lobby.positions[username]
+            lobby.ready_players.discard(username)
+            await notify_clients(lobby_id, {
+                "lobby_id": lobby_id,
+                "players": lobby.players,
+                "status": lobby.status
+            })
+            log.info(f"Removed {username} from lobby {lobby_id} due to disconnect")
+    log.info(f"WebSocket client disconnected: {client_ip}")
 
-async def notify_clients(lobby_id: str, message: dict):
-    if lobby_id in clients:
-        for client in list(clients[lobby_id]):
-            try:
-                await client.send_json(message)
-            except Exception as e:
-                clients[lobby_id].remove(client)
-                print(f"Removed disconnected client from lobby {lobby_id}: {e}")
\ No newline at end of file
+async def _close_quietly(websocket: WebSocket):
+    with contextlib.suppress(Exception):
+        await websocket.close()
+
+async def notify_clients(lobby_id: str, message: Optional[dict] = None, payload: Optional[bytes] = None):
+    """Broadcast to every socket in a lobby.
+
+    Callers that fan the same message out to several lobbies can encode
+    it once with orjson.dumps and pass the bytes as payload, skipping
+    the per-lobby encode.
+    """
+    socks = clients.get(lobby_id)
+    if not socks:
+        return
+    data = orjson.dumps(message) if payload is None else payload
+    dead = [client for client in socks if not _enqueue(client, data)]
+    if dead:
+        socks.difference_update(dead)
+        for client in dead:
+            outboxes.pop(client, None)
+            # Close the socket so its receive loop runs the normal
+            # disconnect cleanup; otherwise the player lingers in the
+            # lobby with every reply silently dropped.
+            asyncio.ensure_future(_close_quietly(client))
+        log.warning(f"Dropped {len(dead)} unresponsive client(s) from lobby {lobby_id}")
\ No newline at end of file